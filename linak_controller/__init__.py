@@ -0,0 +1,2 @@
+from .api import DeskController, DeskState, NotConnectedError
+from .desk import DeskError, MoveResult
@@ -0,0 +1,134 @@
+"""
+Spread desk connections over several bluetooth adapters.
+"""
+
+import asyncio
+from collections import Counter
+from typing import Dict, List, Optional, Sequence
+from bleak import BleakError, BleakScanner
+from .config import Config
+from .desk import Desk
+from .util import logger
+
+# Signal strength used for desks an adapter has not seen
+UNSEEN_RSSI = -127
+
+
+def get_adapters(config: Config) -> List[str]:
+    """The configured adapters, from a list or a comma separated string"""
+    adapters = config["adapters"] or []
+    if isinstance(adapters, str):
+        adapters = adapters.split(",")
+    return [adapter.strip() for adapter in adapters if adapter.strip()]
+
+
+class AdapterBalancer:
+    """
+    Assigns each desk to the adapter with the best signal strength, penalised by
+    adapter_load_penalty dBm for each desk already connected through that adapter.
+    Only adapters that have seen the desk are used, unless none have. Adapters with
+    adapter_capacity connections are only used when all are full.
+    """
+
+    def __init__(self, config: Config):
+        self.config = config
+        self.adapters = get_adapters(config)
+        self.rssi: Dict[str, Dict[str, int]] = {adapter: {} for adapter in self.adapters}
+        self.assigned: Dict[str, str] = {}
+        self.connections: Counter = Counter()
+        self.failures: Counter = Counter()
+        self.scanning = asyncio.Lock()
+
+    async def scan(self) -> None:
+        """Scan on every adapter at once, recording the signal strength of each desk"""
+        async with self.scanning:
+            await asyncio.gather(
+                *(self.scan_adapter(adapter) for adapter in self.adapters)
+            )
+
+    async def scan_adapter(self, adapter: str) -> None:
+        try:
+            devices = await BleakScanner.discover(
+                device=adapter, timeout=self.config["scan_timeout"], return_adv=True
+            )
+        except (BleakError, OSError) as e:
+            logger.log("Scanning with {} failed: {}".format(adapter, e))
+            return
+        self.rssi[adapter] = {
+            address.upper(): adv.rssi for address, (_, adv) in devices.items()
+        }
+        logger.log("Found {} devices using {}".format(len(devices), adapter))
+
+    def load(self, adapter: str) -> int:
+        return sum(1 for assigned in self.assigned.values() if assigned == adapter)
+
+    def score(self, adapter: str, mac_address: str) -> float:
+        rssi = self.rssi[adapter].get(mac_address, UNSEEN_RSSI)
+        return rssi - self.config["adapter_load_penalty"] * self.load(adapter)
+
+    def seen(self, mac_address: str) -> List[str]:
+        return [adapter for adapter in self.adapters if mac_address in self.rssi[adapter]]
+
+    def assign(self, mac_address: str, exclude: Sequence[str] = ()) -> str:
+        """Choose an adapter for the desk, replacing any previous assignment"""
+        self.release(mac_address)
+        available = [adapter for adapter in self.adapters if adapter not in exclude]
+        seen = [adapter for adapter in self.seen(mac_address) if adapter in available]
+        if not seen:
+            logger.log("{} has not been seen by any adapter".format(mac_address))
+        seen = seen or available
+        candidates = [
+            adapter
+            for adapter in seen
+            if self.load(adapter) < self.config["adapter_capacity"]
+        ] or seen
+        adapter = max(candidates, key=lambda adapter: self.score(adapter, mac_address))
+        self.assigned[mac_address] = adapter
+        return adapter
+
+    def release(self, mac_address: str) -> Optional[str]:
+        return self.assigned.pop(mac_address, None)
+
+    async def connect(self, config: Config, refresh: bool = False) -> Desk:
+        """
+        Connect to the desk through the best adapter, trying the next best if that
+        fails. Scans again first when refreshing (e.g. reconnecting) or when no
+        adapter has seen the desk, as it may have moved since the last scan.
+        """
+        mac_address = config["mac_address"]
+        if refresh or not self.seen(mac_address):
+            await self.scan()
+        failed = []
+        while True:
+            config = config.copy()
+            config["adapter_name"] = self.assign(mac_address, failed)
+            logger.log(
+                "Connecting to {} using {}".format(mac_address, config["adapter_name"])
+            )
+            try:
+                desk = await Desk.connect(config)
+                self.connections[config["adapter_name"]] += 1
+                return desk
+            except (BleakError, asyncio.TimeoutError, OSError) as e:
+                self.release(mac_address)
+                self.failures[config["adapter_name"]] += 1
+                failed.append(config["adapter_name"])
+                if len(failed) == len(self.adapters):
+                    raise
+                logger.log(
+                    "Connecting using {} failed: {}".format(
+                        config["adapter_name"], str(e) or type(e).__name__
+                    )
+                )
+
+    def stats(self) -> dict:
+        return {
+            adapter: {
+                "connected": self.load(adapter),
+                "utilisation": self.load(adapter) / self.config["adapter_capacity"],
+                "total_connections": self.connections[adapter],
+                "failed_connections": self.failures[adapter],
+                "seen": len(self.rssi[adapter]),
+            }
+            for adapter in self.adapters
+        }
@@ -0,0 +1,155 @@
+"""
+Admission control for the servers, limiting how many commands reach the desks.
+"""
+
+import asyncio
+import time
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Dict, Optional
+from .config import Config, Command, Commands
+
+# How often to forget rate limits that have fully recovered (seconds)
+PRUNE_PERIOD = 60
+
+
+class Rejected(Exception):
+    pass
+
+
+class TokenBucket:
+    """Allow rate commands per minute on average, with bursts of up to burst commands"""
+
+    def __init__(self, rate: float, burst: int):
+        self.rate = rate / 60
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+
+    def refill(self) -> float:
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        return self.tokens
+
+    def take(self) -> bool:
+        if self.refill() < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+
+class DeskQueue:
+    """Runs commands for one desk one at a time, in the order they arrived"""
+
+    def __init__(self):
+        self.lock = asyncio.Lock()
+        self.length = 0  # waiting or running
+        self.stops = 0
+
+
+class Admission:
+    """
+    Rate limits commands per client and per desk and allows at most
+    max_pending_commands waiting or running for each desk. Moves run straight away
+    as Desk.move_to preempts any move in progress, while other commands are queued
+    so each desk runs one at a time. Stop commands skip the rate limits and the
+    queue, dropping any waiting commands.
+    """
+
+    def __init__(self, config: Config):
+        self.config = config
+        self.clients: Dict[str, TokenBucket] = {}
+        self.desks: Dict[str, TokenBucket] = {}
+        self.queues: Dict[str, DeskQueue] = {}
+        self.pruned = time.monotonic()
+        self.counters = {
+            "accepted": 0,
+            "rejected_client_rate": 0,
+            "rejected_desk_rate": 0,
+            "rejected_queue_full": 0,
+            "dropped_by_stop": 0,
+        }
+
+    def bucket(self, buckets: Dict[str, TokenBucket], key: str, rate: float):
+        if key not in buckets:
+            buckets[key] = TokenBucket(rate, self.config["rate_limit_burst"])
+        return buckets[key]
+
+    def prune(self) -> None:
+        """Forget buckets that are full again, as they behave like new ones"""
+        now = time.monotonic()
+        if now - self.pruned < PRUNE_PERIOD:
+            return
+        self.pruned = now
+        for buckets in (self.clients, self.desks):
+            for key, bucket in list(buckets.items()):
+                if bucket.refill() >= bucket.burst:
+                    del buckets[key]
+
+    def check(self, client: str, desk: str) -> Optional[str]:
+        """Return why the command should be rejected, or None to accept it"""
+        queue = self.queues.get(desk)
+        if queue and queue.length >= max(self.config["max_pending_commands"], 1):
+            self.counters["rejected_queue_full"] += 1
+            return "Too many pending commands"
+        self.prune()
+        buckets = []
+        client_rate = self.config["client_rate_limit"]
+        if client_rate:
+            buckets.append((self.bucket(self.clients, client, client_rate), "client"))
+        desk_rate = self.config["desk_rate_limit"]
+        if desk_rate:
+            buckets.append((self.bucket(self.desks, desk, desk_rate), "desk"))
+        # Only take tokens once every limit allows the command
+        for bucket, name in buckets:
+            if bucket.refill() < 1:
+                self.counters[f"rejected_{name}_rate"] += 1
+                return "{} rate limit exceeded".format(name.capitalize())
+        for bucket, _ in buckets:
+            bucket.take()
+        return None
+
+    @asynccontextmanager
+    async def admit(self, client: str, command: Command) -> AsyncIterator[None]:
+        """
+        Hold a pending slot while the command runs, waiting for the desk to be free
+        unless it is a move. Raises Rejected if the command is rate limited, the
+        queue is full or a stop arrives while waiting
+        """
+        desk = (command.get("mac_address") or self.config["mac_address"] or "").upper()
+        if command.get("key") == Commands.stop:
+            queue = self.queues.get(desk)
+            if queue:
+                queue.stops += 1
+            self.counters["accepted"] += 1
+            yield
+            return
+        reason = self.check(client, desk)
+        if reason:
+            raise Rejected(reason)
+        queue = self.queues.setdefault(desk, DeskQueue())
+        queue.length += 1
+        stops = queue.stops
+        try:
+            if command.get("key") == Commands.move_to:
+                # A new target preempts the current move rather than waiting for it
+                self.counters["accepted"] += 1
+                yield
+                return
+            async with queue.lock:
+                if queue.stops != stops:
+                    self.counters["dropped_by_stop"] += 1
+                    raise Rejected("Stopped before the command could run")
+                self.counters["accepted"] += 1
+                yield
+        finally:
+            queue.length -= 1
+            if not queue.length:
+                del self.queues[desk]
+
+    def stats(self) -> dict:
+        return {
+            "pending": sum(queue.length for queue in self.queues.values()),
+            "queues": {desk: queue.length for desk, queue in self.queues.items()},
+            **self.counters,
+        }
@@ -0,0 +1,212 @@
+"""
+Sit/stand analytics over recorded height and speed samples.
+
+Recordings are CSV files with one `timestamp,height,speed` row per sample, where
+timestamp is in unix seconds and height and speed are the raw values reported by
+the desk (10ths of a mm and 100ths of a mm/s). These are written by `--watch`
+when `--record` is given, which writes a sample when it starts, whenever the desk
+reports a change and at least every RECORD_HEARTBEAT seconds. When recording stops
+an end row with a height of END_HEIGHT (`timestamp,-1,0`) marks the following gap.
+Each recording is for one desk, and several can be analysed together.
+"""
+
+import os
+import warnings
+from collections import defaultdict
+from typing import Dict, List, NamedTuple
+from .config import Config
+from .util import logger
+
+try:
+    import numpy as np
+except ImportError:  # pragma: no cover
+    np = None
+
+MOVING = "moving"
+SECONDS_PER_DAY = 86400
+# Longest time between samples while recording
+RECORD_HEARTBEAT = 60
+# Height of the row marking the end of a recording, desks never report negative heights
+END_HEIGHT = -1
+
+
+class Samples(NamedTuple):
+    timestamp: "np.ndarray"  # float64 unix seconds
+    height: "np.ndarray"  # int32 10ths of a mm above base height
+    speed: "np.ndarray"  # int32 100ths of a mm/s
+    end: "np.ndarray"  # bool, rows marking the end of a recording
+
+
+class DaySummary(NamedTuple):
+    day: str
+    durations: dict  # position name -> seconds spent there
+    transitions: int
+    moves: int
+    move_time: float
+
+
+def require_numpy():
+    if np is None:
+        raise RuntimeError(
+            "Analytics requires numpy, install it with: pip install linak-controller[analytics]"
+        )
+
+
+def load_samples(path: str) -> Samples:
+    """Load a recording into arrays sorted by timestamp"""
+    require_numpy()
+    with warnings.catch_warnings():
+        # Empty recordings are reported by the caller
+        warnings.simplefilter("ignore", UserWarning)
+        try:
+            data = np.loadtxt(path, delimiter=",", ndmin=2, dtype=np.float64)
+        except ValueError:
+            # Older recordings ended with empty fields, which loadtxt cannot parse
+            data = np.genfromtxt(path, delimiter=",", dtype=np.float64)
+    data = data.reshape(-1, 3)
+    data = data[np.argsort(data[:, 0], kind="stable")]
+    end = np.isnan(data[:, 1]) | (data[:, 1] == END_HEIGHT)
+    values = np.nan_to_num(data[:, 1:]).astype(np.int32)
+    return Samples(data[:, 0], values[:, 0], values[:, 1], end)
+
+
+def classify(heights_mm: "np.ndarray", favourites: dict) -> "np.ndarray":
+    """Index of the nearest favourite for each height"""
+    positions = np.asarray(list(favourites.values()), dtype=np.float64)
+    return np.abs(heights_mm[:, None] - positions[None, :]).argmin(axis=1)
+
+
+def analyse(
+    samples: Samples,
+    base_height: float,
+    favourites: dict,
+    max_gap: float = 5 * RECORD_HEARTBEAT,
+) -> List[DaySummary]:
+    """
+    Aggregate time spent at each favourite position, transitions between them and
+    moves per (UTC) day. Each sample holds until the next one, split at midnight.
+    Time after an end row is not counted, nor are intervals longer than max_gap,
+    which can only come from a recording that was not stopped cleanly.
+    """
+    require_numpy()
+    names = list(favourites) + [MOVING]
+    if len(samples.timestamp) == 0 or not favourites:
+        return []
+
+    timestamp = samples.timestamp
+    heights_mm = samples.height / 10 + base_height
+    moving = samples.speed != 0
+    position = np.where(moving, len(names) - 1, classify(heights_mm, favourites))
+    dt = np.diff(timestamp, append=timestamp[-1])
+    counted = ~samples.end & (dt <= max_gap)
+
+    # Split counted intervals at midnight, carrying the position forward
+    day_number = (timestamp // SECONDS_PER_DAY).astype(np.int64)
+    midnights = np.arange(day_number[0] + 1, day_number[-1] + 1) * SECONDS_PER_DAY
+    previous = np.searchsorted(timestamp, midnights, side="right") - 1
+    midnights, previous = midnights[counted[previous]], previous[counted[previous]]
+    order = np.argsort(np.concatenate([timestamp, midnights]), kind="stable")
+    split_time = np.concatenate([timestamp, midnights])[order]
+    split_sample = np.concatenate([np.arange(len(timestamp)), previous])[order]
+    split_dt = np.diff(split_time, append=split_time[-1])
+    split_day = (split_time // SECONDS_PER_DAY).astype(np.int64)
+
+    days = np.unique(split_day)
+    day_index = np.searchsorted(days, day_number)
+
+    # Time at each position per day
+    durations = np.bincount(
+        np.searchsorted(days, split_day) * len(names) + position[split_sample],
+        weights=np.where(counted[split_sample], split_dt, 0),
+        minlength=len(days) * len(names),
+    ).reshape(len(days), len(names))
+
+    # Transitions between resting positions, counted on the day they complete
+    resting = np.flatnonzero(~moving & ~samples.end)
+    changed = resting[1:][position[resting[1:]] != position[resting[:-1]]]
+    transitions = np.bincount(day_index[changed], minlength=len(days))
+
+    # Runs of moving samples, lasting until the first sample at rest or end row
+    edges = np.diff(moving.astype(np.int8), prepend=0, append=0)
+    starts = np.flatnonzero(edges == 1)
+    ends = np.minimum(np.flatnonzero(edges == -1), len(moving) - 1)
+    move_days = day_index[starts]
+    moves = np.bincount(move_days, minlength=len(days))
+    move_time = np.bincount(
+        move_days,
+        weights=samples.timestamp[ends] - samples.timestamp[starts],
+        minlength=len(days),
+    )
+
+    labels = (days * SECONDS_PER_DAY).astype("datetime64[s]").astype("datetime64[D]")
+    return [
+        DaySummary(
+            str(labels[i]),
+            dict(zip(names, durations[i].tolist())),
+            int(transitions[i]),
+            int(moves[i]),
+            float(move_time[i]),
+        )
+        for i in range(len(days))
+    ]
+
+
+def combine(summaries: List[List[DaySummary]]) -> List[DaySummary]:
+    """Add up the per day summaries of several desks"""
+    days: Dict[str, list] = defaultdict(lambda: [defaultdict(float), 0, 0, 0.0])
+    for desk in summaries:
+        for summary in desk:
+            total = days[summary.day]
+            for name, seconds in summary.durations.items():
+                total[0][name] += seconds
+            total[1] += summary.transitions
+            total[2] += summary.moves
+            total[3] += summary.move_time
+    return [
+        DaySummary(day, dict(total[0]), total[1], total[2], total[3])
+        for day, total in sorted(days.items())
+    ]
+
+
+def log_summaries(name: str, summaries: List[DaySummary]) -> None:
+    for summary in summaries:
+        positions = " ".join(
+            "{}: {:.1f}h".format(position, seconds / 3600)
+            for position, seconds in summary.durations.items()
+            if position != MOVING
+        )
+        logger.log(
+            "{} {} {} Transitions: {} Moves: {} ({:.0f}s)".format(
+                name,
+                summary.day,
+                positions,
+                summary.transitions,
+                summary.moves,
+                summary.move_time,
+            )
+        )
+
+
+def run_analytics(config: Config, paths: str) -> None:
+    """
+    Print per day sit/stand analytics for a comma separated list of recordings,
+    one per desk, followed by the totals across all desks
+    """
+    if config["base_height"] is None:
+        logger.log("Analytics requires base_height to be configured")
+        return
+    if not config["favourites"]:
+        logger.log("Analytics requires favourites to be configured")
+        return
+    desks = []
+    for path in (path.strip() for path in paths.split(",") if path.strip()):
+        summaries = analyse(
+            load_samples(path), config["base_height"], config["favourites"]
+        )
+        if not summaries:
+            logger.log("No samples found in {}".format(path))
+            continue
+        log_summaries(os.path.splitext(os.path.basename(path))[0], summaries)
+        desks.append(summaries)
+    if len(desks) > 1:
+        log_summaries("All {} desks".format(len(desks)), combine(desks))
@@ -0,0 +1,138 @@
+"""
+Async API for controlling a desk from other Python programs.
+
+Unlike the command line tool this never parses arguments, touches the config
+directory or exits the process. Failures are raised as exceptions, e.g. BleakError
+or asyncio.TimeoutError when connecting and ValueError for invalid heights.
+
+    async with DeskController({"mac_address": "AA:AA:AA:AA:AA:AA"}) as desk:
+        await desk.move_to("stand")
+        async for state in desk.subscribe():
+            print(state["height"])
+
+Errors reported by the desk while moving (e.g. hitting an obstacle) stop the desk
+and are raised from move_to as DeskError, or can be watched with errors().
+"""
+
+import asyncio
+from typing import AsyncIterator, Optional, Set, TypedDict, Union
+from .config import Config, load_config
+from .desk import Desk, DeskError, MoveResult
+from .gatt import ReferenceOutputService
+from .util import Height, Speed
+
+
+class NotConnectedError(Exception):
+    pass
+
+
+class DeskState(TypedDict):
+    height: int  # mm above the floor
+    speed: float  # mm/s
+
+
+class DeskController:
+    config: Config
+    desk: Optional[Desk] = None
+
+    def __init__(self, config: dict):
+        self.config = load_config(config)
+        if not self.config["mac_address"]:
+            raise ValueError("Mac address must be provided")
+        self.subscribers: Set[asyncio.Queue] = set()
+
+    async def __aenter__(self) -> "DeskController":
+        await self.connect()
+        return self
+
+    async def __aexit__(self, *exc) -> None:
+        await self.disconnect()
+
+    @property
+    def is_connected(self) -> bool:
+        return bool(self.desk and self.desk.client.is_connected)
+
+    async def connect(self) -> None:
+        """Connect to the desk, or reconnect if the connection was lost"""
+        if self.is_connected:
+            return
+        if self.desk:
+            self.desk.disconnecting = False
+            await self.desk.client.connect(timeout=self.config["connection_timeout"])
+            await self.desk.watch_errors()
+            if self.subscribers:
+                await ReferenceOutputService.ONE.subscribe(
+                    self.desk.client, self.notify
+                )
+        else:
+            self.desk = await Desk.connect(self.config)
+
+    async def disconnect(self) -> None:
+        """Stop the desk and disconnect"""
+        if self.is_connected:
+            await self.desk.cancel_move(MoveResult.cancelled)
+            await self.desk.stop()
+            await self.desk.disconnect()
+
+    def connected_desk(self) -> Desk:
+        if not self.is_connected:
+            raise NotConnectedError("Not connected to {}".format(self.config["mac_address"]))
+        return self.desk
+
+    async def move_to(self, value: Union[int, str]) -> MoveResult:
+        """
+        Move to a height (mm) or favourite, preempting any move in progress
+        Raises DeskError if the desk reports an error (e.g. a collision) while moving
+        """
+        desk = self.connected_desk()
+        result = await desk.move_to(desk.resolve_target(value))
+        if result == MoveResult.error and desk.last_error:
+            raise desk.last_error
+        return result
+
+    async def stop(self) -> None:
+        """Stop the desk, interrupting any move in progress"""
+        desk = self.connected_desk()
+        await desk.cancel_move(MoveResult.stopped)
+        await desk.stop()
+
+    async def state(self) -> DeskState:
+        """Read the current height and speed"""
+        height, speed = await self.connected_desk().get_height_speed()
+        return self.to_state(height, speed)
+
+    async def subscribe(self) -> AsyncIterator[DeskState]:
+        """Yield the height and speed each time the desk reports a change"""
+        desk = self.connected_desk()
+        queue: asyncio.Queue = asyncio.Queue()
+        if not self.subscribers:
+            await ReferenceOutputService.ONE.subscribe(desk.client, self.notify)
+        self.subscribers.add(queue)
+        try:
+            while True:
+                yield await queue.get()
+        finally:
+            self.subscribers.discard(queue)
+            if not self.subscribers and self.is_connected:
+                await ReferenceOutputService.ONE.unsubscribe(desk.client)
+
+    async def errors(self) -> AsyncIterator[DeskError]:
+        """Yield each error the desk reports, after the desk has been stopped"""
+        desk = self.connected_desk()
+        queue: asyncio.Queue = asyncio.Queue()
+        desk.error_listeners.add(queue.put_nowait)
+        try:
+            while True:
+                yield await queue.get()
+        finally:
+            desk.error_listeners.discard(queue.put_nowait)
+
+    def notify(self, sender, data: bytearray) -> None:
+        height, speed = ReferenceOutputService.decode_height_speed(data)
+        state = self.to_state(height, speed)
+        for queue in self.subscribers:
+            queue.put_nowait(state)
+
+    def to_state(self, height: Height, speed: Speed) -> DeskState:
+        height.base_height = self.desk.config["base_height"]
+        return DeskState(height=height.human, speed=speed.human)
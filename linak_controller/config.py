@@ -24,12 +24,17 @@ class Commands(str, Enum):
     scan_adapter = "scan_adapter"
     server = "server"
     tcp_server = "tcp_server"
+    stop = "stop"
+    analyse = "analyse"
 
 
 class Config(TypedDict):
     mac_address: Optional[str]
     base_height: Optional[int]
     adapter_name: str
+    adapters: list
+    adapter_capacity: int
+    adapter_load_penalty: float
     scan_timeout: int
     connection_timeout: int
     server_address: str
@@ -37,12 +42,39 @@ class Config(TypedDict):
     favourites: dict
     forward: bool
     move_command_period: float
+    move_timeout: float
+    record_path: Optional[str]
+    gatt_trace_path: Optional[str]
+    replay_path: Optional[str]
+    replay_speed: float
+    replay_strict: bool
+    profile_path: Optional[str]
+    groups: dict
+    group_concurrency: int
+    pool: bool
+    pool_size: int
+    pool_warm_size: int
+    pool_idle_timeout: float
+    max_pending_commands: int
+    client_rate_limit: float
+    desk_rate_limit: float
+    rate_limit_burst: int
+    mqtt_host: Optional[str]
+    mqtt_port: int
+    mqtt_username: Optional[str]
+    mqtt_password: Optional[str]
+    mqtt_topic: str
+    mqtt_rate_limit: float
+    mqtt_reconnect_period: float
 
 default_config = Config(
     {
         "mac_address": None,
         "base_height": None,
         "adapter_name": "hci0",
+        "adapters": [],
+        "adapter_capacity": 5,
+        "adapter_load_penalty": 10,
         "scan_timeout": 5,
         "connection_timeout": 10,
         "server_address": "127.0.0.1",
@@ -50,17 +82,61 @@ default_config = Config(
         "favourites": {},
         "forward": False,
         "move_command_period": 0.4,
+        "move_timeout": 60,
+        "record_path": None,
+        "gatt_trace_path": None,
+        "replay_path": None,
+        "replay_speed": 1.0,
+        "replay_strict": False,
+        "profile_path": None,
+        "groups": {},
+        "group_concurrency": 4,
+        "pool": False,
+        "pool_size": 4,
+        "pool_warm_size": 1,
+        "pool_idle_timeout": 60,
+        "max_pending_commands": 8,
+        "client_rate_limit": 30,
+        "desk_rate_limit": 60,
+        "rate_limit_burst": 5,
+        "mqtt_host": None,
+        "mqtt_port": 1883,
+        "mqtt_username": None,
+        "mqtt_password": None,
+        "mqtt_topic": "linak-controller",
+        "mqtt_rate_limit": 0.5,
+        "mqtt_reconnect_period": 5,
     }
 )
 
 class Command(TypedDict):
     key: Optional[Commands]
     value: Optional[str]
+    group: Optional[str]
 
 
-def get_config() -> tuple[Config, Command]:
+def load_config(*sources: Optional[dict]) -> Config:
+    """
+    Build a config from the defaults, overwritten by each source in turn
+    Unknown keys are ignored and nothing is read from or written to disk
+    Raises ValueError for invalid values
+    """
     config = default_config.copy()
+    for source in sources:
+        for key in config:
+            if source and key in source:
+                config[key] = source[key]
+
+    if config["mac_address"]:
+        config["mac_address"] = config["mac_address"].upper()
+
+    if config["adapter_capacity"] < 1:
+        raise ValueError("adapter_capacity must be at least 1")
 
+    return config
+
+
+def get_config() -> tuple[Config, Command]:
     OLD_CONFIG_DIR = user_config_dir("idasen-controller")
     OLD_CONFIG_PATH = os.path.join(OLD_CONFIG_DIR, "config.yaml")
 
@@ -100,6 +176,24 @@ def get_config() -> tuple[Config, Command]:
         type=str,
         help="The bluetooth adapter device name",
     )
+    parser.add_argument(
+        "--adapters",
+        dest="adapters",
+        type=str,
+        help="Comma separated bluetooth adapters to spread connections over with --pool or --group",
+    )
+    parser.add_argument(
+        "--adapter-capacity",
+        dest="adapter_capacity",
+        type=int,
+        help="The number of connections each adapter should hold before using others",
+    )
+    parser.add_argument(
+        "--adapter-load-penalty",
+        dest="adapter_load_penalty",
+        type=float,
+        help="How much weaker (dBm) a signal is preferred over an adapter with one more connection",
+    )
     parser.add_argument(
         "--scan-timeout",
         dest="scan_timeout",
@@ -118,12 +212,146 @@ def get_config() -> tuple[Config, Command]:
         type=float,
         help="The period between each move command (seconds)",
     )
+    parser.add_argument(
+        "--move-timeout",
+        dest="move_timeout",
+        type=float,
+        help="The maximum time a move can take before the desk is stopped (seconds)",
+    )
+    parser.add_argument(
+        "--record",
+        dest="record_path",
+        type=str,
+        help="Append raw height and speed samples to this CSV file when watching",
+    )
+    parser.add_argument(
+        "--gatt-trace",
+        dest="gatt_trace_path",
+        type=str,
+        help="Record all bluetooth GATT traffic with the desk to this trace file",
+    )
+    parser.add_argument(
+        "--replay",
+        dest="replay_path",
+        type=str,
+        help="Replay a trace recorded with --gatt-trace instead of connecting to the desk",
+    )
+    parser.add_argument(
+        "--replay-speed",
+        dest="replay_speed",
+        type=float,
+        help="Speed up replays by this factor, or 0 to replay without delays",
+    )
+    parser.add_argument(
+        "--replay-strict",
+        dest="replay_strict",
+        action="store_true",
+        default=None,
+        help="Fail the replay on the first operation that does not match the trace",
+    )
+    parser.add_argument(
+        "--profile",
+        dest="profile_path",
+        type=str,
+        help="Write timings for each phase of the command to this Chrome trace file",
+    )
+    parser.add_argument(
+        "--group",
+        dest="group",
+        type=str,
+        help="Run the command on a configured group or comma separated list of mac addresses",
+    )
+    parser.add_argument(
+        "--group-concurrency",
+        dest="group_concurrency",
+        type=int,
+        help="The maximum number of desks in a group to move at once",
+    )
     parser.add_argument(
         "--forward",
         dest="forward",
         action="store_true",
         help="Forward any commands to a server",
     )
+    parser.add_argument(
+        "--pool",
+        dest="pool",
+        action="store_true",
+        default=None,
+        help="Connect to desks on demand when running a server instead of holding one connection",
+    )
+    parser.add_argument(
+        "--pool-size",
+        dest="pool_size",
+        type=int,
+        help="The maximum number of desks the server keeps connected at once",
+    )
+    parser.add_argument(
+        "--pool-warm-size",
+        dest="pool_warm_size",
+        type=int,
+        help="The number of most recently used desks kept connected when idle",
+    )
+    parser.add_argument(
+        "--pool-idle-timeout",
+        dest="pool_idle_timeout",
+        type=float,
+        help="Disconnect desks idle for this long when using --pool (seconds)",
+    )
+    parser.add_argument(
+        "--max-pending-commands",
+        dest="max_pending_commands",
+        type=int,
+        help="The maximum number of commands waiting or running for each desk",
+    )
+    parser.add_argument(
+        "--client-rate-limit",
+        dest="client_rate_limit",
+        type=float,
+        help="The number of commands per minute the server accepts from each client",
+    )
+    parser.add_argument(
+        "--desk-rate-limit",
+        dest="desk_rate_limit",
+        type=float,
+        help="The number of commands per minute the server accepts for each desk",
+    )
+    parser.add_argument(
+        "--rate-limit-burst",
+        dest="rate_limit_burst",
+        type=int,
+        help="The number of commands that can be sent at once before the rate limits apply",
+    )
+    parser.add_argument(
+        "--mqtt-host",
+        dest="mqtt_host",
+        type=str,
+        help="The MQTT broker the server should publish state to and take commands from",
+    )
+    parser.add_argument(
+        "--mqtt-port",
+        dest="mqtt_port",
+        type=int,
+        help="The port of the MQTT broker",
+    )
+    parser.add_argument(
+        "--mqtt-topic",
+        dest="mqtt_topic",
+        type=str,
+        help="The MQTT topic prefix for state, availability and commands",
+    )
+    parser.add_argument(
+        "--mqtt-rate-limit",
+        dest="mqtt_rate_limit",
+        type=float,
+        help="The minimum time between MQTT state updates (seconds)",
+    )
+    parser.add_argument(
+        "--mqtt-reconnect-period",
+        dest="mqtt_reconnect_period",
+        type=float,
+        help="The time to wait before reconnecting to the MQTT broker (seconds)",
+    )
     parser.add_argument(
         "--server-address",
         dest="server_address",
@@ -162,6 +390,13 @@ def get_config() -> tuple[Config, Command]:
         const=Commands.move_to,
         help="Move desk to specified height (mm) or to a favourite position",
     )
+    cmd.add_argument(
+        "--stop",
+        dest="command",
+        action="store_const",
+        const=Commands.stop,
+        help="Stop the desk, interrupting any move in progress on a server",
+    )
     cmd.add_argument(
         "--scan",
         dest="command",
@@ -183,6 +418,14 @@ def get_config() -> tuple[Config, Command]:
         const=Commands.tcp_server,
         help="Run as a simple TCP server to accept forwarded commands",
     )
+    cmd.add_argument(
+        "--analyse",
+        dest="analyse",
+        action=CommandAction,
+        type=str,
+        const=Commands.analyse,
+        help="Print sit/stand analytics for comma separated recordings made with --record, one per desk",
+    )
 
     args = {k: v for k, v in vars(parser.parse_args()).items() if v is not None}
 
@@ -206,20 +449,15 @@ def get_config() -> tuple[Config, Command]:
     else:
         print("No config file found")
 
-    for key in config:
-        if key in config_file:
-            config[key] = config_file[key]
+    # Overwrite the defaults with config.yaml and then command line args
+    try:
+        config = load_config(config_file, args)
+    except ValueError as e:
+        parser.error(str(e))
 
-    # Overwrite config from command line args
-    for key in config:
-        if key in args:
-            config[key] = args[key]
-
-    if not config["mac_address"]:
+    if not config["mac_address"] and not args.get("group"):
         parser.error("Mac address must be provided")
 
-    config["mac_address"] = config["mac_address"].upper()
-
     IS_WINDOWS = sys.platform == "win32"
 
     if IS_WINDOWS:
@@ -230,7 +468,8 @@ def get_config() -> tuple[Config, Command]:
     command = Command(
         {
             "key": args.get("command"),
-            "value": args.get("move_to"),
+            "value": args.get("move_to", args.get("analyse")),
+            "group": args.get("group"),
         }
     )
 
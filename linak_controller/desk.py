@@ -3,9 +3,11 @@ High level helper class to organise methods for performing actions with a Linak
 """
 
 import asyncio
+import time
 from bleak import BleakClient
-from bleak.exc import BleakDBusError
-from typing import Tuple
+from bleak.exc import BleakDBusError, BleakError
+from typing import Optional, Tuple, Union
+from enum import Enum
 from .gatt import (
     DPGService,
     ControlService,
@@ -13,21 +15,77 @@ from .gatt import (
     ReferenceOutputService,
 )
 from .config import Config
+from .recording import RecordingClient
+from .analytics import END_HEIGHT, RECORD_HEARTBEAT
+from .profiling import profiler
 from .util import logger, bytes_to_hex, Height, Speed
 import struct
 
 
+class MoveResult(str, Enum):
+    reached = "reached"
+    preempted = "preempted"
+    stopped = "stopped"
+    deadline = "deadline"
+    cancelled = "cancelled"
+    error = "error"
+
+
+class DeskError(Exception):
+    """An error reported by the desk controller, such as hitting an obstacle"""
+
+    def __init__(self, code: int, data: bytearray):
+        super().__init__("Desk reported error {} ({})".format(code, bytes_to_hex(data)))
+        self.code = code
+        self.data = data
+
+    def to_dict(self) -> dict:
+        return {"code": self.code, "data": bytes(self.data).hex()}
+
+
 class Desk:
     client: BleakClient = None
     config: Config = None
     disconnecting = False
+    move_task: Optional[asyncio.Task] = None
+    move_end_reason: MoveResult = MoveResult.cancelled
+    last_error: Optional[DeskError] = None
 
     def __init__(self, config: Config, client: BleakClient):
         self.client = client
         self.config = config
+        self.error_listeners = set()
+        self.connection_listeners = set()
+        self.tasks = set()
 
     @classmethod
-    async def initialise(cls, config: Config, client: BleakClient) -> None:
+    async def connect(
+        cls,
+        config: Config,
+        disconnected_callback=None,
+        trace_path: Optional[str] = None,
+    ) -> "Desk":
+        """Connect to and initialise the configured desk, raising on failure"""
+        client = BleakClient(
+            config["mac_address"],
+            device=config["adapter_name"],
+            disconnected_callback=disconnected_callback,
+        )
+        if trace_path:
+            client = RecordingClient(client, trace_path)
+        # Bleak also discovers the services as part of connecting
+        with profiler.span("BleakClient.connect", address=config["mac_address"]):
+            await client.connect(timeout=config["connection_timeout"])
+        logger.log("Connected: {}".format(config["mac_address"]))
+        try:
+            with profiler.span("Desk.initialise"):
+                return await cls.initialise(config, client)
+        except BaseException:
+            await client.disconnect()
+            raise
+
+    @classmethod
+    async def initialise(cls, config: Config, client: BleakClient) -> "Desk":
         desk = cls(config, client)
 
         # Read capabilities
@@ -56,58 +114,205 @@ class Desk:
             desk.config["base_height"] = config["base_height"]
         logger.log("Base height:{:4.0f}mm".format(desk.config["base_height"]))
 
+        await desk.watch_errors()
+
         return desk
 
-    async def wakeup(self) -> None:
-        await ControlService.COMMAND.write_command(
-            self.client, ControlService.COMMAND.CMD_WAKEUP
-        )
+    async def disconnect(self) -> None:
+        """Attempt to disconnect cleanly"""
+        if self.client.is_connected:
+            self.disconnecting = True
+            with profiler.span("disconnect"):
+                await self.client.disconnect()
 
-    async def move_to(self, target: Height) -> None:
-        initial_height, speed = await ReferenceOutputService.get_height_speed(self.client)
-        initial_height.base_height = self.config["base_height"]
-        if initial_height.value == target.value:
-            return
+    def resolve_target(self, value: Union[int, str]) -> Height:
+        """Convert a height (mm) or favourite name into a validated target height"""
+        favourites = self.config["favourites"]
+        base_height = self.config["base_height"]
+        if value in favourites:
+            target = Height(favourites[value], base_height, True)
+        elif str(value).isnumeric():
+            target = Height(int(value), base_height, True)
+        else:
+            raise ValueError(f"Not a valid height or favourite position: {value}")
 
-        await self.wakeup()
-        await self.stop()
+        # Validate target height is not below base height or above maximum
+        if target.value < 0:
+            raise ValueError(
+                f"Cannot move to {target.human:.0f}mm - it's below the base height of {base_height}mm"
+            )
+        if target.value > 65535:
+            max_height = base_height + (65535 / 10)
+            raise ValueError(
+                f"Cannot move to {target.human:.0f}mm - it's above the maximum height of {max_height:.0f}mm"
+            )
+        return target
 
-        data = ReferenceInputService.encode_height(target.value)
+    async def watch_errors(self) -> None:
+        """Listen for errors so a blocked move is stopped as soon as it is reported"""
+        loop = asyncio.get_running_loop()
 
-        while True:
-            await ReferenceInputService.ONE.write(self.client, data)
-            await asyncio.sleep(self.config["move_command_period"])
-            height, speed = await ReferenceOutputService.get_height_speed(self.client)
-            height.base_height = self.config["base_height"]
-            if speed.value == 0:
-                break
-            logger.log(
-                "Height:{:4.0f}mm Speed: {:2.0f}mm/s".format(height.human, speed.human)
+        def callback(sender, data):
+            code = ControlService.ERROR.decode_error(data)
+            if code:
+                error = DeskError(code, data)
+                loop.call_soon_threadsafe(self.background, self.handle_error(error))
+
+        try:
+            await ControlService.ERROR.subscribe(self.client, callback)
+        except BleakError as e:
+            logger.log("Could not listen for desk errors: {}".format(e))
+
+    def background(self, coroutine) -> None:
+        task = asyncio.create_task(coroutine)
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    async def handle_error(self, error: DeskError) -> None:
+        """Abort any move and send a stop to clear the error, then tell listeners"""
+        self.last_error = error
+        logger.log(str(error))
+        if self.move_task and not self.move_task.done():
+            # Stops the desk as the move is cancelled
+            await self.cancel_move(MoveResult.error)
+        else:
+            await self.stop()
+        for listener in list(self.error_listeners):
+            listener(error)
+
+    def connection_changed(self, connected: bool) -> None:
+        """Tell listeners the connection was lost or has been re-established"""
+        for listener in list(self.connection_listeners):
+            listener(connected)
+
+    async def wakeup(self) -> None:
+        with profiler.span("wakeup"):
+            await ControlService.COMMAND.write_command(
+                self.client, ControlService.COMMAND.CMD_WAKEUP
             )
 
+    async def move_to(self, target: Height) -> MoveResult:
+        """
+        Move to the target height, preempting any move already in progress. Returns
+        why the move ended, giving up after move_timeout seconds.
+        """
+        await self.cancel_move(MoveResult.preempted)
+        task = asyncio.create_task(self._move_to(target), name="move_to")
+        self.move_task = task
+        try:
+            return await asyncio.wait_for(
+                asyncio.shield(task), self.config["move_timeout"]
+            )
+        except asyncio.TimeoutError:
+            logger.log("Move timed out")
+            await self.cancel_move(MoveResult.deadline)
+        except asyncio.CancelledError:
+            if not task.done():
+                # The caller was cancelled rather than the move
+                await self.cancel_move(MoveResult.cancelled)
+                raise
+        finally:
+            if self.move_task is task:
+                self.move_task = None
+        # A move cancelled before it started running cannot return its own reason
+        return self.move_end_reason if task.cancelled() else task.result()
+
+    async def cancel_move(self, reason: MoveResult = MoveResult.stopped) -> None:
+        """Interrupt the active move (if any) and wait for the desk to be stopped"""
+        task = self.move_task
+        if task and not task.done():
+            self.move_end_reason = reason
+            task.cancel()
+            await asyncio.wait([task])
+
+    async def _move_to(self, target: Height) -> MoveResult:
+        try:
+            initial_height, speed = await ReferenceOutputService.get_height_speed(
+                self.client
+            )
+            initial_height.base_height = self.config["base_height"]
+            if initial_height.value == target.value:
+                return MoveResult.reached
+
+            await self.wakeup()
+            await self.stop()
+
+            data = ReferenceInputService.encode_height(target.value)
+
+            iteration = 0
+            while True:
+                with profiler.span("move_to iteration", iteration=iteration):
+                    await ReferenceInputService.ONE.write(self.client, data)
+                    await asyncio.sleep(self.config["move_command_period"])
+                    height, speed = await ReferenceOutputService.get_height_speed(
+                        self.client
+                    )
+                iteration += 1
+                height.base_height = self.config["base_height"]
+                if speed.value == 0:
+                    return MoveResult.reached
+                logger.log(
+                    "Height:{:4.0f}mm Speed: {:2.0f}mm/s".format(
+                        height.human, speed.human
+                    )
+                )
+        except asyncio.CancelledError:
+            try:
+                await asyncio.wait_for(self.stop(), self.config["connection_timeout"])
+            except asyncio.TimeoutError:
+                logger.log("Stopping the desk timed out")
+            return self.move_end_reason
+
     async def get_height_speed(self) -> Tuple[Height, Speed]:
         height, speed = await ReferenceOutputService.get_height_speed(self.client)
         height.base_height = self.config["base_height"]
         return height, speed
 
     async def watch_height_speed(self) -> None:
-        """Listen for height changes"""
+        """Listen for height changes, optionally recording raw samples"""
+        record = None
+        if self.config["record_path"]:
+            record = open(self.config["record_path"], "a", buffering=1)
+            logger.log("Recording samples to {}".format(self.config["record_path"]))
+
+        def write_sample(height: Height, speed: Speed) -> None:
+            record.write("{:.3f},{},{}\n".format(time.time(), height.value, speed.value))
 
         def callback(sender, data):
+            nonlocal latest
             height, speed = ReferenceOutputService.decode_height_speed(data)
             height.base_height = self.config["base_height"]
+            latest = height, speed
+            if record:
+                write_sample(height, speed)
             logger.log(
                 "Height:{:4.0f}mm Speed: {:2.0f}mm/s".format(height.human, speed.human)
             )
 
+        latest = None
+        if record:
+            latest = await self.get_height_speed()
+            write_sample(*latest)
         await ReferenceOutputService.ONE.subscribe(self.client, callback)
-        await asyncio.Future()
+        try:
+            if not record:
+                await asyncio.Future()
+            while True:
+                # Heartbeat so that analytics can tell resting from not recording
+                await asyncio.sleep(RECORD_HEARTBEAT)
+                write_sample(*latest)
+        finally:
+            if record:
+                # End row marking that nothing is known until the next sample
+                record.write("{:.3f},{},0\n".format(time.time(), END_HEIGHT))
+                record.close()
 
     async def stop(self) -> None:
         try:
-            await ControlService.COMMAND.write_command(
-                self.client, ControlService.COMMAND.CMD_STOP
-            )
+            with profiler.span("stop"):
+                await ControlService.COMMAND.write_command(
+                    self.client, ControlService.COMMAND.CMD_STOP
+                )
         except BleakDBusError as e:
             # Harmless exception that happens on Raspberry Pis
             # bleak.exc.BleakDBusError: [org.bluez.Error.NotPermitted] Write acquired
@@ -6,6 +6,7 @@ import struct
 from bleak import BleakClient
 from typing import Optional, Tuple, Union
 from .util import Height, Speed, make_iter
+from .profiling import profiler
 
 
 class Characteristic:
@@ -124,6 +125,11 @@ class ControlCommandCharacteristic(Characteristic):
 class ControlErrorCharacteristic(Characteristic):
     uuid = "99fa0003-338a-1024-8a49-009c0215f78a"
 
+    @classmethod
+    def decode_error(cls, data: bytearray) -> int:
+        """The error code from a notification, or 0 when the error has cleared"""
+        return data[0] if data else 0
+
 
 class ControlService(Service):
     uuid = "99fa0001-338a-1024-8a49-009c0215f78a"
@@ -176,16 +182,17 @@ class DPGService(Service):
     async def dpg_command(
         cls, client: BleakClient, command: int, data: Optional[bytearray] = None
     ) -> bytearray:
-        iter, callback = make_iter()
-        await cls.DPG.subscribe(client, callback)
-        if data:
-            await cls.DPG.write_command(client, command, data)
-        else:
-            await cls.DPG.read_command(client, command)
-        async for sender, data in iter:
-            # Return the first response from the callback
-            await cls.DPG.unsubscribe(client)
-            if data[0] == 1:
-                return data[2:]
+        with profiler.span("dpg_command", command=command, write=bool(data)):
+            iter, callback = make_iter()
+            await cls.DPG.subscribe(client, callback)
+            if data:
+                await cls.DPG.write_command(client, command, data)
             else:
-                return None
+                await cls.DPG.read_command(client, command)
+            async for sender, data in iter:
+                # Return the first response from the callback
+                await cls.DPG.unsubscribe(client)
+                if data[0] == 1:
+                    return data[2:]
+                else:
+                    return None
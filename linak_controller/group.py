@@ -0,0 +1,127 @@
+"""
+Move a group of desks at the same time.
+"""
+
+import asyncio
+import re
+from typing import List, Optional, TypedDict, Union
+from bleak import BleakError
+from .config import Config
+from .desk import Desk, MoveResult
+from .adapters import AdapterBalancer, get_adapters
+from .util import logger
+
+MAC_ADDRESS = re.compile(r"^([0-9A-F]{2}:){5}[0-9A-F]{2}$", re.IGNORECASE)
+
+
+class GroupMoveResult(TypedDict):
+    mac_address: str
+    ok: bool
+    result: Union[MoveResult, None]
+    height: Union[int, None]
+    error: Union[str, None]
+
+
+def get_group(config: Config, group: str) -> List[str]:
+    """Return the mac addresses for a configured group name or a comma separated list"""
+    if group in config["groups"]:
+        macs = config["groups"][group]
+    else:
+        macs = [mac for mac in group.split(",") if mac.strip()]
+    if not macs:
+        raise ValueError(f"No desks found for group: {group}")
+    macs = [mac.strip().upper() for mac in macs]
+    invalid = [mac for mac in macs if not MAC_ADDRESS.match(mac)]
+    if invalid:
+        raise ValueError(
+            "Unknown group or invalid mac address: {}".format(", ".join(invalid))
+        )
+    return macs
+
+
+async def move_desk(
+    config: Config,
+    value: Union[int, str],
+    balancer: Optional[AdapterBalancer] = None,
+) -> GroupMoveResult:
+    """Connect to a single desk, move it to the target and disconnect"""
+    desk = None
+    result = GroupMoveResult(
+        mac_address=config["mac_address"],
+        ok=False,
+        result=None,
+        height=None,
+        error=None,
+    )
+    try:
+        if balancer:
+            desk = await balancer.connect(config)
+        else:
+            desk = await Desk.connect(config)
+        target = desk.resolve_target(value)
+        result["result"] = await desk.move_to(target)
+        height, _ = await desk.get_height_speed()
+        result["ok"] = result["result"] == MoveResult.reached
+        result["height"] = height.human
+    except Exception as e:
+        # One desk failing must not abort the moves of the others
+        result["error"] = str(e) or type(e).__name__
+    finally:
+        if desk:
+            try:
+                await desk.stop()
+                await desk.disconnect()
+            except (BleakError, asyncio.TimeoutError, OSError):
+                pass
+    return result
+
+
+async def move_group(
+    config: Config, macs: List[str], value: Union[int, str]
+) -> List[GroupMoveResult]:
+    """Move all desks concurrently, connecting to at most group_concurrency at once"""
+    semaphore = asyncio.Semaphore(max(config["group_concurrency"], 1))
+    balancer = None
+    if get_adapters(config):
+        balancer = AdapterBalancer(config)
+        await balancer.scan()
+
+    async def run(mac: str) -> GroupMoveResult:
+        desk_config = config.copy()
+        desk_config["mac_address"] = mac
+        async with semaphore:
+            try:
+                return await move_desk(desk_config, value, balancer)
+            finally:
+                if balancer:
+                    balancer.release(mac)
+
+    logger.log(f"Moving {len(macs)} desks to {value}")
+    results = await asyncio.gather(*(run(mac) for mac in macs), return_exceptions=True)
+    for i, result in enumerate(results):
+        if isinstance(result, Exception):
+            results[i] = GroupMoveResult(
+                mac_address=macs[i],
+                ok=False,
+                result=None,
+                height=None,
+                error=str(result) or type(result).__name__,
+            )
+    for result in results:
+        if result["error"]:
+            # The move may have finished before reading the final height failed
+            moved = " after move {}".format(result["result"].value) if result["result"] else ""
+            logger.log(
+                "{}: Failed{} - {}".format(result["mac_address"], moved, result["error"])
+            )
+        elif result["ok"]:
+            logger.log(
+                "{}: OK ({:4.0f}mm)".format(result["mac_address"], result["height"])
+            )
+        elif result["result"]:
+            logger.log(
+                "{}: Move {} ({:4.0f}mm)".format(
+                    result["mac_address"], result["result"].value, result["height"]
+                )
+            )
+    return results
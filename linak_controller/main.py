@@ -1,5 +1,6 @@
 #!/usr/bin/env python3
 import os
+import time
 import traceback
 import asyncio
 import aiohttp
@@ -7,17 +8,27 @@ from aiohttp import web
 from bleak import BleakClient, BleakError, BleakScanner
 import json
 from functools import partial
+from contextlib import asynccontextmanager
 from .config import get_config, Config, Command, Commands
-from .util import Height, logger
-from .desk import Desk
+from .util import logger
+from .desk import Desk, DeskError, MoveResult
+from .analytics import run_analytics
+from .group import get_group, move_group
+from .pool import DeskPool
+from .adapters import AdapterBalancer, get_adapters
+from .mqtt import MqttBridge
+from .admission import Admission, Rejected
+from .recording import ReplayClient, ReplayMismatch
+from .profiling import profiler
 
 
 async def scan(config: Config):
     """Scan for a bluetooth device with the configured address and return it or return all devices if no address specified"""
     logger.log("Scanning\r", end="")
-    devices = await BleakScanner().discover(
-        device=config["adapter_name"], timeout=config["scan_timeout"]
-    )
+    with profiler.span("scan", adapter=config["adapter_name"]):
+        devices = await BleakScanner().discover(
+            device=config["adapter_name"], timeout=config["scan_timeout"]
+        )
     logger.log("Found {} devices using {}".format(len(devices), config["adapter_name"]))
     for device in devices:
         logger.log(device)
@@ -29,6 +40,7 @@ def disconnect_callback(client: BleakClient, _=None):
     global desk_for_disconnect
     if not desk_for_disconnect.disconnecting:
         logger.log("Lost connection with {}".format(client.address))
+        desk_for_disconnect.connection_changed(False)
         asyncio.create_task(connect(desk_for_disconnect.config, desk_for_disconnect))
 
 
@@ -36,20 +48,31 @@ async def connect(config: Config, desk=None, attempt=0):
     """Attempt to connect to the desk"""
     try:
         logger.log("Connecting\r", end="")
-        if not desk:
-            client = BleakClient(
-                config["mac_address"],
-                device=config["adapter_name"],
-                disconnected_callback=disconnect_callback,
+        if config["replay_path"]:
+            client = ReplayClient(
+                config["replay_path"], config["replay_speed"], config["replay_strict"]
+            )
+            await client.connect()
+            logger.log("Replaying: {}".format(config["replay_path"]))
+            # The time between move commands is sped up along with the trace
+            speed = config["replay_speed"]
+            config["move_command_period"] = (
+                config["move_command_period"] / speed if speed else 0
             )
-            await client.connect(timeout=config["connection_timeout"])
-            logger.log("Connected: {}".format(config["mac_address"]))
             desk = await Desk.initialise(config, client)
+        elif not desk:
+            desk = await Desk.connect(
+                config,
+                disconnected_callback=disconnect_callback,
+                trace_path=config["gatt_trace_path"],
+            )
             global desk_for_disconnect
             desk_for_disconnect = desk
         else:
             await desk.client.connect(timeout=config["connection_timeout"])
+            await desk.watch_errors()
             logger.log("Reconnected: {}".format(config["mac_address"]))
+            desk.connection_changed(True)
         return desk
     except BleakError as e:
         logger.log("Connecting failed")
@@ -57,68 +80,72 @@ async def connect(config: Config, desk=None, attempt=0):
             logger.log(e)
         else:
             logger.log(traceback.format_exc())
-        os._exit(1)
+        abort(config)
     except asyncio.exceptions.TimeoutError as e:
         logger.log("Connecting failed - timed out")
-        os._exit(1)
-    except OSError as e:
+        abort(config)
+    except (OSError, ReplayMismatch) as e:
         logger.log(e)
-        os._exit(1)
+        abort(config)
+
+
+def save_profile(config: Config):
+    """Write the profile if --profile was given"""
+    if config and config["profile_path"]:
+        profiler.save(config["profile_path"])
+        logger.log("Saved profile to {}".format(config["profile_path"]))
+
+
+def abort(config: Config):
+    """Exit straight away, even from a reconnection task, keeping the profile"""
+    save_profile(config)
+    os._exit(1)
 
 
 async def disconnect(desk: Desk):
     """Attempt to disconnect cleanly"""
-    if desk.client.is_connected:
-        desk.disconnecting = True
-        await desk.client.disconnect()
+    await desk.disconnect()
 
 
 async def run_command(desk: Desk, command: Command):
     """Begin the action specified by command line arguments and config"""
+    if command["key"] == Commands.stop:
+        # Stop straight away, interrupting any move in progress
+        await desk.cancel_move(MoveResult.stopped)
+        await desk.stop()
+        logger.log("Stopped")
+        return MoveResult.stopped
+
     # Always print current height
     initial_height, _ = await desk.get_height_speed()
     logger.log("Height: {:4.0f}mm".format(initial_height.human))
     target = None
-    
+    result = None
+
     if command["key"] == Commands.watch:
         # Print changes to height data
         logger.log("Watching for changes to desk height and speed")
         await desk.watch_height_speed()
     elif command["key"] == Commands.move_to:
         # Move to custom height
+        try:
+            target = desk.resolve_target(command["value"])
+        except ValueError as e:
+            logger.log(e)
+            return
         if command["value"] in desk.config["favourites"]:
-            target = Height(
-                desk.config["favourites"].get(command["value"]), desk.config["base_height"], True
-            )
             logger.log(
                 f"""Moving to favourite height: {command["value"]} ({target.human} mm)"""
             )
-        elif str(command["value"]).isnumeric():
-            target = Height(int(command["value"]), desk.config["base_height"], True)
-            logger.log(f"""Moving to height: {command["value"]}""")
         else:
-            logger.log(
-                f"""Not a valid height or favourite position: {command["value"]}"""
-            )
-            return
-
-        # Validate target height is not below base height or above maximum
-        if target.value < 0:
-            logger.log(
-                f"""Cannot move to {target.human:.0f}mm - it's below the base height of {desk.config["base_height"]}mm"""
-            )
-            return
-        if target.value > 65535:
-            max_height = desk.config["base_height"] + (65535 / 10)
-            logger.log(
-                f"""Cannot move to {target.human:.0f}mm - it's above the maximum height of {max_height:.0f}mm"""
-            )
-            return
+            logger.log(f"""Moving to height: {command["value"]}""")
 
         if target.value == initial_height.value:
             logger.log(f"Nothing to do - already at specified height")
-            return
-        await desk.move_to(target)
+            return MoveResult.reached
+        result = await desk.move_to(target)
+        if result != MoveResult.reached:
+            logger.log(f"Move ended: {result.value}")
     if target:
         final_height, _ = await desk.get_height_speed()
         # If we were moving to a target height, wait, then print the actual final height
@@ -127,51 +154,106 @@ async def run_command(desk: Desk, command: Command):
                 final_height.human, target.human
             )
         )
+    return result
 
 
-async def run_tcp_server(desk: Desk):
+class DeskUnavailable(Exception):
+    """The desk could not be reached, e.g. connecting or a bluetooth operation failed"""
+
+
+async def run_leased_command(lease, admission: Admission, client: str, command: Command):
+    """
+    Run a command on the desk it targets, borrowing the connection from lease
+    Raises Rejected if admission control sheds the command, ValueError if the
+    desk cannot be leased, DeskUnavailable if the desk cannot be reached and
+    DeskError if the desk reported an error while moving
+    """
+    try:
+        async with admission.admit(client, command):
+            async with lease(command.get("mac_address")) as desk:
+                result = await run_command(desk, command)
+                if result == MoveResult.error and desk.last_error:
+                    raise desk.last_error
+                return result
+    except Rejected as e:
+        logger.log("Rejected command from {}: {} {}".format(client, e, admission.stats()))
+        raise
+    except ValueError as e:
+        logger.log("Rejected command from {}: {}".format(client, e))
+        raise
+    except (BleakError, asyncio.exceptions.TimeoutError, OSError) as e:
+        reason = str(e) or type(e).__name__
+        logger.log("Desk unavailable: {}".format(reason))
+        raise DeskUnavailable(reason) from e
+
+
+async def run_tcp_server(config: Config, lease, stats, admission: Admission = None):
     """Start a simple tcp server to listen for commands"""
 
+    admission = admission or Admission(config)
     server = await asyncio.start_server(
-        partial(run_tcp_forwarded_command, desk),
-        desk.config["server_address"],
-        desk.config["server_port"],
+        partial(run_tcp_forwarded_command, lease, admission),
+        config["server_address"],
+        config["server_port"],
     )
     logger.log("TCP Server listening")
     await server.serve_forever()
 
 
-async def run_tcp_forwarded_command(desk: Desk, reader, writer):
+async def run_tcp_forwarded_command(lease, admission: Admission, reader, writer):
     """Run commands received by the tcp server"""
     logger.log("Received command")
     request = (await reader.read()).decode("utf8")
     command = json.loads(str(request))
-    await run_command(desk, command)
+    client = writer.get_extra_info("peername")
+    try:
+        await run_leased_command(lease, admission, str(client and client[0]), command)
+    except (Rejected, ValueError, DeskUnavailable, DeskError) as e:
+        writer.write("Error: {}\n".format(e).encode("utf8"))
+        await writer.drain()
     writer.close()
 
 
-async def run_http_server(desk: Desk):
+async def run_http_server(config: Config, lease, stats, admission: Admission = None):
     """Start a server to listen for commands via websocket connection"""
+    admission = admission or Admission(config)
     app = web.Application()
-    app.router.add_post("/", partial(run_forwarded_http_command, desk))
-    app.router.add_get("/ws", partial(run_forwarded_ws_command, desk))
+    app.router.add_post("/", partial(run_forwarded_http_command, lease, admission))
+    app.router.add_get("/ws", partial(run_forwarded_ws_command, lease, admission))
+    app.router.add_get("/stats", partial(get_server_stats, stats, admission))
     runner = web.AppRunner(app)
     await runner.setup()
-    site = web.TCPSite(runner, desk.config["server_address"], desk.config["server_port"])
+    site = web.TCPSite(runner, config["server_address"], config["server_port"])
     await site.start()
     logger.log("Server listening")
     await asyncio.Future()
 
 
-async def run_forwarded_http_command(desk: Desk, request):
+async def get_server_stats(stats, admission: Admission, request):
+    """Report server statistics"""
+    return web.json_response({**stats(), "admission": admission.stats()})
+
+
+async def run_forwarded_http_command(lease, admission: Admission, request):
     """Run commands received by the server"""
     logger.log("Received command")
     command = await request.json()
-    await run_command(desk, command)
-    return web.Response(text="OK")
+    try:
+        result = await run_leased_command(lease, admission, request.remote, command)
+    except Rejected as e:
+        return web.Response(status=429, text=str(e))
+    except ValueError as e:
+        return web.Response(status=400, text=str(e))
+    except DeskUnavailable as e:
+        return web.Response(status=503, text=str(e))
+    except DeskError as e:
+        return web.json_response(
+            {"result": MoveResult.error.value, "error": e.to_dict()}, status=409
+        )
+    return web.Response(text=result.value if result else "OK")
 
 
-async def run_forwarded_ws_command(desk: Desk, request):
+async def run_forwarded_ws_command(lease, admission: Admission, request):
     """
     Run commands received by the server via websocket connection
     This allows live streaming of the logs back to the client
@@ -201,7 +283,14 @@ async def run_forwarded_ws_command(desk: Desk, request):
     async for msg in ws:
         if msg.type == aiohttp.WSMsgType.TEXT:
             command = json.loads(msg.data)
-            await run_command(desk, command)
+            try:
+                await run_leased_command(lease, admission, request.remote, command)
+            except (Rejected, ValueError, DeskUnavailable) as e:
+                await ws.send_str(json.dumps({"error": str(e)}))
+            except DeskError as e:
+                await ws.send_str(
+                    json.dumps({"result": MoveResult.error.value, "error": e.to_dict()})
+                )
         break
     await asyncio.sleep(1)  # Allows final messages to send on web socket
     await ws.close()
@@ -210,10 +299,13 @@ async def run_forwarded_ws_command(desk: Desk, request):
 
 async def forward_command(config: Config, command: Command):
     """Send commands to a server instance of this script"""
-    allowed_commands = [None, Commands.move_to]
+    allowed_commands = [None, Commands.move_to, Commands.stop]
     if command["key"] not in allowed_commands:
         logger.log(f"Command must be one of {allowed_commands}")
         return
+    if command.get("group"):
+        logger.log("Group commands cannot be forwarded")
+        return
     session = aiohttp.ClientSession()
     ws = await session.ws_connect(
         f"""http://{config["server_address"]}:{config["server_port"]}/ws"""
@@ -229,25 +321,89 @@ async def forward_command(config: Config, command: Command):
     await session.close()
 
 
+async def run_server(config: Config, command: Command):
+    """Run a server that connects to desks on demand using a pool"""
+    if config["mqtt_host"]:
+        logger.log("The MQTT bridge is not available in pool mode")
+    balancer = None
+    if get_adapters(config):
+        balancer = AdapterBalancer(config)
+        await balancer.scan()
+    pool = DeskPool(config, balancer)
+    pool.start()
+    try:
+        if command["key"] == Commands.server:
+            await run_http_server(config, pool.lease, pool.stats)
+        else:
+            await run_tcp_server(config, pool.lease, pool.stats)
+    finally:
+        await pool.close()
+
+
 async def main():
     """Set up the async event loop and signal handlers"""
     desk = None
+    config = None
+    started = time.perf_counter()
     try:
         config, command = get_config()
-        # Forward and scan don't require a connection so run them and exit
+        if config["profile_path"]:
+            profiler.enable(started)
+            profiler.add("get_config", started, time.perf_counter())
+        # Forward, scan and analyse don't require a connection so run them and exit
         if config["forward"]:
             await forward_command(config, command)
         elif command["key"] == Commands.scan_adapter:
             await scan(config)
+        elif command["key"] == Commands.analyse:
+            run_analytics(config, command["value"])
+        elif command.get("group"):
+            if command["key"] != Commands.move_to:
+                logger.log("Groups can only be used with --move-to")
+                return
+            try:
+                macs = get_group(config, command["group"])
+            except ValueError as e:
+                logger.log(str(e))
+                return
+            await move_group(config, macs, command["value"])
+        elif config["pool"] and command["key"] in [Commands.server, Commands.tcp_server]:
+            await run_server(config, command)
         else:
             # Server and other commands do require a connection so set one up
-            desk = await connect(config)
-            if command["key"] == Commands.server:
-                await run_http_server(desk)
-            elif command["key"] == Commands.tcp_server:
-                await run_tcp_server(desk)
+            with profiler.span("connect"):
+                desk = await connect(config)
+
+            @asynccontextmanager
+            async def lease(mac_address=None):
+                if mac_address and mac_address.upper() != desk.config["mac_address"]:
+                    raise ValueError(
+                        "Not connected to {}, use --pool to control other desks".format(
+                            mac_address
+                        )
+                    )
+                yield desk
+
+            def stats():
+                return {"connected": [desk.config["mac_address"]]}
+
+            if command["key"] in [Commands.server, Commands.tcp_server]:
+                # Shared so MQTT commands are limited and queued with the others
+                admission = Admission(config)
+                servers = [
+                    run_http_server(config, lease, stats, admission)
+                    if command["key"] == Commands.server
+                    else run_tcp_server(config, lease, stats, admission)
+                ]
+                if config["mqtt_host"]:
+                    run_mqtt_command = partial(
+                        run_leased_command, lease, admission, "mqtt"
+                    )
+                    servers.append(MqttBridge(config, desk, run_mqtt_command).run())
+                await asyncio.gather(*servers)
             else:
-                await run_command(desk, command)
+                with profiler.span("run_command", command=command["key"]):
+                    await run_command(desk, command)
     except Exception as e:
         logger.log("\nSomething unexpected went wrong:")
         logger.log(traceback.format_exc())
@@ -257,6 +413,7 @@ async def main():
             await desk.stop()
             await disconnect(desk)
             logger.log("Disconnected         ")
+        save_profile(config)
 
 
 def init():
@@ -0,0 +1,208 @@
+"""
+Bridge between a desk and an MQTT broker, publishing state changes and accepting commands.
+
+Topics (under mqtt_topic):
+- `state`: `{"height": <mm>, "speed": <mm/s>}` whenever the desk reports a change
+- `availability`: retained `online` while connected to the broker and the desk, else `offline`
+- `error`: `{"code": <code>, "data": <hex>}` when the desk reports an error such as a collision
+- `command`: a command object like the HTTP server accepts, or just a height or favourite name
+"""
+
+import asyncio
+import json
+from typing import Optional, Tuple
+from bleak import BleakError
+from .config import Config, Commands
+from .desk import Desk, DeskError
+from .gatt import ReferenceOutputService
+from .util import logger, Height, Speed
+
+try:
+    import aiomqtt
+except ImportError:  # pragma: no cover
+    aiomqtt = None
+
+ONLINE = "online"
+OFFLINE = "offline"
+
+
+class MqttBridge:
+    def __init__(self, config: Config, desk: Desk, run_command):
+        if aiomqtt is None:
+            raise RuntimeError(
+                "MQTT requires aiomqtt, install it with: pip install linak-controller[mqtt]"
+            )
+        self.config = config
+        self.desk = desk
+        self.run_command = run_command
+        self.topic = config["mqtt_topic"].rstrip("/")
+        # Only the latest state is needed, older ones would be skipped anyway
+        self.states: asyncio.Queue = asyncio.Queue(maxsize=1)
+        self.tasks = set()
+        self.client = None
+        self.loop = None
+
+    async def run(self) -> None:
+        """Stay connected to the broker, reconnecting if the connection is lost"""
+        self.loop = asyncio.get_running_loop()
+        await ReferenceOutputService.ONE.subscribe(self.desk.client, self.notify)
+        self.desk.error_listeners.add(self.publish_error)
+        self.desk.connection_listeners.add(self.connection_changed)
+        while True:
+            try:
+                await self.serve()
+            except aiomqtt.MqttError as e:
+                logger.log("MQTT connection lost: {}".format(e))
+                await asyncio.sleep(self.config["mqtt_reconnect_period"])
+
+    async def serve(self) -> None:
+        availability = f"{self.topic}/availability"
+        async with aiomqtt.Client(
+            self.config["mqtt_host"],
+            self.config["mqtt_port"],
+            username=self.config["mqtt_username"],
+            password=self.config["mqtt_password"],
+            will=aiomqtt.Will(availability, OFFLINE, qos=1, retain=True),
+        ) as client:
+            logger.log(
+                "MQTT connected to {}:{}".format(
+                    self.config["mqtt_host"], self.config["mqtt_port"]
+                )
+            )
+            await self.publish_availability(client)
+            await client.subscribe(f"{self.topic}/command")
+            self.client = client
+            publisher = asyncio.create_task(self.publish_states(client))
+            try:
+                # Publish the current state straight away
+                if self.desk.client.is_connected:
+                    self.put_state(await self.desk.get_height_speed())
+                async for message in client.messages:
+                    self.handle_command(message.payload)
+            finally:
+                self.client = None
+                publisher.cancel()
+                if not publisher.done():
+                    await asyncio.wait([publisher])
+                await self.publish_offline(client, availability)
+
+    async def publish_offline(self, client, availability: str) -> None:
+        try:
+            await client.publish(availability, OFFLINE, qos=1, retain=True)
+        except aiomqtt.MqttError:
+            pass
+
+    async def publish_availability(self, client) -> None:
+        """Publish whether the desk can currently be controlled"""
+        available = ONLINE if self.desk.client.is_connected else OFFLINE
+        await client.publish(
+            f"{self.topic}/availability", available, qos=1, retain=True
+        )
+
+    def notify(self, sender, data: bytearray) -> None:
+        state = ReferenceOutputService.decode_height_speed(data)
+        self.loop.call_soon_threadsafe(self.put_state, state)
+
+    def put_state(self, state: Tuple[Height, Speed]) -> None:
+        """Queue a state, replacing any that has not been published yet"""
+        if self.states.full():
+            self.states.get_nowait()
+        self.states.put_nowait(state)
+
+    def connection_changed(self, connected: bool) -> None:
+        self.background(self.desk_reconnected() if connected else self.desk_lost())
+
+    async def desk_lost(self) -> None:
+        try:
+            if self.client:
+                await self.publish_availability(self.client)
+        except aiomqtt.MqttError as e:
+            logger.log("MQTT publish failed: {}".format(e))
+
+    async def desk_reconnected(self) -> None:
+        """Notifications do not survive a reconnection so subscribe again"""
+        try:
+            await ReferenceOutputService.ONE.subscribe(self.desk.client, self.notify)
+            if self.client:
+                await self.publish_availability(self.client)
+                self.put_state(await self.desk.get_height_speed())
+        except (aiomqtt.MqttError, BleakError, asyncio.TimeoutError) as e:
+            logger.log("Restoring MQTT state failed: {}".format(e))
+
+    async def publish_states(self, client) -> None:
+        """
+        Publish height and speed notifications, skipping unchanged values and
+        publishing at most once per mqtt_rate_limit. The latest value is always
+        published once the rate limit allows, so the final position is not lost.
+        """
+        loop = asyncio.get_running_loop()
+        period = self.config["mqtt_rate_limit"]
+        published: Optional[Tuple[int, int]] = None
+        latest: Optional[Tuple[Height, Speed]] = None
+        last_publish = -period
+
+        def key(state: Tuple[Height, Speed]) -> Tuple[int, int]:
+            return state[0].value, state[1].value
+
+        while True:
+            timeout = None
+            if latest is not None and key(latest) != published:
+                timeout = max(0, last_publish + period - loop.time())
+            try:
+                latest = await asyncio.wait_for(self.states.get(), timeout)
+            except asyncio.TimeoutError:
+                pass
+            if key(latest) == published or loop.time() < last_publish + period:
+                continue
+            height, speed = latest
+            height.base_height = self.desk.config["base_height"]
+            await client.publish(
+                f"{self.topic}/state",
+                json.dumps({"height": height.human, "speed": speed.human}),
+                retain=True,
+            )
+            published = key(latest)
+            last_publish = loop.time()
+
+    def publish_error(self, error: DeskError) -> None:
+        if not self.client:
+            return
+        self.background(
+            self.client.publish(f"{self.topic}/error", json.dumps(error.to_dict()))
+        )
+
+    def background(self, coroutine) -> None:
+        task = asyncio.create_task(coroutine)
+        self.tasks.add(task)
+        task.add_done_callback(self.finished)
+
+    def finished(self, task: asyncio.Task) -> None:
+        self.tasks.discard(task)
+        if not task.cancelled() and task.exception():
+            error = task.exception()
+            logger.log("MQTT task failed: {}".format(str(error) or type(error).__name__))
+
+    def handle_command(self, payload) -> None:
+        """
+        Run commands in the background so a new command can preempt a move. Commands
+        go through the same rate limits and queue as the server's other commands.
+        """
+        try:
+            command = json.loads(payload)
+        except ValueError:
+            try:
+                command = payload.decode("utf8").strip()
+            except UnicodeDecodeError:
+                logger.log("Ignoring MQTT command that is not valid UTF-8")
+                return
+        if not isinstance(command, dict):
+            command = {"key": Commands.move_to, "value": str(command)}
+        if command.get("key") not in [Commands.move_to, Commands.stop]:
+            logger.log(
+                "Ignoring MQTT command, key must be one of: {}, {}".format(
+                    Commands.move_to.value, Commands.stop.value
+                )
+            )
+            return
+        logger.log("Received MQTT command")
+        self.background(self.run_command(command))
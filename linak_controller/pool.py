@@ -0,0 +1,182 @@
+"""
+Pool of desk connections for the servers, connecting lazily and disconnecting idle desks.
+"""
+
+import asyncio
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Dict, Optional
+from bleak import BleakError
+from .config import Config
+from .desk import Desk
+from .adapters import AdapterBalancer
+from .util import logger
+
+
+class PooledDesk:
+    desk: Desk
+    users: int = 0
+    last_used: float = 0
+
+    def __init__(self, desk: Desk):
+        self.desk = desk
+        self.last_used = asyncio.get_running_loop().time()
+
+    @property
+    def is_connected(self) -> bool:
+        return self.desk.client.is_connected
+
+
+class DeskPool:
+    """
+    Desks are connected on first use and kept in least recently used order. At most
+    pool_size desks are connected or connecting at once, so a new desk waits while
+    all of them are in use. Desks that have been idle for
+    pool_idle_timeout are disconnected unless they are one of the pool_warm_size
+    most recently used. With a balancer each (re)connection picks an adapter.
+    """
+
+    def __init__(self, config: Config, balancer: Optional[AdapterBalancer] = None):
+        self.config = config
+        self.balancer = balancer
+        self.desks: "OrderedDict[str, PooledDesk]" = OrderedDict()
+        self.locks: Dict[str, asyncio.Lock] = {}
+        # Signalled whenever a connection slot may have been freed
+        self.changed = asyncio.Condition()
+        self.connecting = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.idle_disconnects = 0
+        self.reaper = None
+
+    def start(self) -> None:
+        if self.config["pool_idle_timeout"] and not self.reaper:
+            self.reaper = asyncio.create_task(self.reap())
+
+    async def close(self) -> None:
+        if self.reaper:
+            self.reaper.cancel()
+            self.reaper = None
+        while self.desks:
+            _, entry = self.desks.popitem()
+            await self.release(entry)
+
+    @asynccontextmanager
+    async def lease(self, mac_address: Optional[str] = None) -> AsyncIterator[Desk]:
+        """Borrow a connected desk, connecting to it if needed"""
+        mac_address = (mac_address or self.config["mac_address"]).upper()
+        entry = await self.acquire(mac_address)
+        entry.users += 1
+        try:
+            yield entry.desk
+        finally:
+            entry.users -= 1
+            entry.last_used = asyncio.get_running_loop().time()
+            async with self.changed:
+                self.changed.notify_all()
+
+    async def acquire(self, mac_address: str) -> PooledDesk:
+        lock = self.locks.setdefault(mac_address, asyncio.Lock())
+        async with lock:
+            entry = self.desks.get(mac_address)
+            if entry and entry.is_connected:
+                self.hits += 1
+                self.desks.move_to_end(mac_address)
+                return entry
+            self.misses += 1
+            reconnecting = entry is not None
+            if entry:
+                del self.desks[mac_address]
+            await self.reserve()
+            config = self.config.copy()
+            config["mac_address"] = mac_address
+            try:
+                if self.balancer:
+                    desk = await self.balancer.connect(config, refresh=reconnecting)
+                else:
+                    logger.log(
+                        "Connecting to {} using {}".format(
+                            mac_address, config["adapter_name"]
+                        )
+                    )
+                    desk = await Desk.connect(config)
+                entry = PooledDesk(desk)
+                self.desks[mac_address] = entry
+            except BaseException:
+                if self.balancer:
+                    self.balancer.release(mac_address)
+                raise
+            finally:
+                async with self.changed:
+                    self.connecting -= 1
+                    self.changed.notify_all()
+            return entry
+
+    async def reserve(self) -> None:
+        """
+        Wait until another desk can be connected, counting connections in progress
+        and desks in use towards pool_size
+        """
+        size = max(self.config["pool_size"], 1)
+        async with self.changed:
+            while True:
+                await self.evict(size - self.connecting - 1)
+                if len(self.desks) + self.connecting < size:
+                    self.connecting += 1
+                    return
+                await self.changed.wait()
+
+    async def evict(self, size: int) -> None:
+        """Disconnect least recently used idle desks until at most size are connected"""
+        for mac_address, entry in list(self.desks.items()):
+            if len(self.desks) <= max(size, 0):
+                break
+            if entry.users:
+                continue
+            del self.desks[mac_address]
+            self.evictions += 1
+            logger.log("Evicting {}".format(mac_address))
+            await self.release(entry)
+
+    async def reap(self) -> None:
+        """Periodically disconnect desks that have been idle for too long"""
+        timeout = self.config["pool_idle_timeout"]
+        while True:
+            await asyncio.sleep(timeout / 2)
+            now = asyncio.get_running_loop().time()
+            warm = list(self.desks)[-self.config["pool_warm_size"] :]
+            if not self.config["pool_warm_size"]:
+                warm = []
+            async with self.changed:
+                for mac_address, entry in list(self.desks.items()):
+                    if mac_address in warm or entry.users:
+                        continue
+                    if now - entry.last_used >= timeout:
+                        del self.desks[mac_address]
+                        self.idle_disconnects += 1
+                        logger.log("Disconnecting idle desk {}".format(mac_address))
+                        await self.release(entry)
+                self.changed.notify_all()
+
+    async def release(self, entry: PooledDesk) -> None:
+        if self.balancer:
+            self.balancer.release(entry.desk.config["mac_address"])
+        try:
+            await entry.desk.stop()
+            await entry.desk.disconnect()
+        except (BleakError, asyncio.TimeoutError, OSError) as e:
+            logger.log("Disconnecting {} failed: {}".format(entry.desk.client.address, e))
+
+    def stats(self) -> dict:
+        requests = self.hits + self.misses
+        return {
+            "connected": list(self.desks),
+            "connecting": self.connecting,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / requests if requests else None,
+            "evictions": self.evictions,
+            "idle_disconnects": self.idle_disconnects,
+            "adapters": self.balancer.stats() if self.balancer else None,
+        }
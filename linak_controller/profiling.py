@@ -0,0 +1,120 @@
+"""
+Timing spans for each phase of a command, exported in the Chrome trace event format.
+
+The exported JSON can be opened in https://ui.perfetto.dev or chrome://tracing.
+Spans are grouped by asyncio task so concurrent moves show as separate tracks.
+Only the most recent MAX_EVENTS spans are kept so long running servers can be profiled.
+"""
+
+import asyncio
+import json
+import os
+import time
+from collections import deque
+from typing import Deque, Dict, Optional
+
+MAX_EVENTS = 100000
+
+
+class NullSpan:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+NULL_SPAN = NullSpan()
+
+
+class Span:
+    def __init__(self, profiler: "Profiler", name: str, args: dict):
+        self.profiler = profiler
+        self.name = name
+        self.args = args
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.profiler.add(self.name, self.start, time.perf_counter(), **self.args)
+        return False
+
+
+class Profiler:
+    enabled = False
+
+    def __init__(self):
+        self.events: Deque[dict] = deque(maxlen=MAX_EVENTS)
+        self.tracks: Dict[int, int] = {}  # running task id -> track id
+        self.names: Dict[int, str] = {}  # track id -> task name
+        self.next_track = 0
+        self.origin = time.perf_counter()
+
+    def enable(self, origin: Optional[float] = None) -> None:
+        self.enabled = True
+        if origin is not None:
+            self.origin = origin
+
+    def span(self, name: str, **args):
+        """Time the enclosed block, doing nothing unless profiling is enabled"""
+        if not self.enabled:
+            return NULL_SPAN
+        return Span(self, name, args)
+
+    def track(self) -> int:
+        """A small id for the current asyncio task so nested spans share a track"""
+        try:
+            task = asyncio.current_task()
+        except RuntimeError:
+            task = None
+        key = id(task) if task else 0
+        if key not in self.tracks:
+            if len(self.names) > MAX_EVENTS:
+                # Forget names of tracks whose spans have all been dropped
+                used = {event["tid"] for event in self.events}
+                self.names = {tid: self.names[tid] for tid in used}
+            self.tracks[key] = self.next_track
+            self.names[self.next_track] = task.get_name() if task else "main"
+            self.next_track += 1
+            if task:
+                # Task ids are reused once a task is finished
+                task.add_done_callback(lambda _: self.tracks.pop(key, None))
+        return self.tracks[key]
+
+    def add(self, name: str, start: float, end: float, **args) -> None:
+        if not self.enabled:
+            return
+        self.events.append(
+            {
+                "name": name,
+                "cat": "linak",
+                "ph": "X",
+                "ts": (start - self.origin) * 1e6,
+                "dur": (end - start) * 1e6,
+                "pid": os.getpid(),
+                "tid": self.track(),
+                "args": args,
+            }
+        )
+
+    def save(self, path: str) -> None:
+        metadata = [
+            {
+                "name": "thread_name",
+                "ph": "M",
+                "pid": os.getpid(),
+                "tid": tid,
+                "args": {"name": self.names[tid]},
+            }
+            for tid in sorted({event["tid"] for event in self.events})
+        ]
+        with open(path, "w") as stream:
+            json.dump(
+                {"traceEvents": metadata + list(self.events), "displayTimeUnit": "ms"},
+                stream,
+            )
+
+
+profiler = Profiler()
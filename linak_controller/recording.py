@@ -0,0 +1,278 @@
+"""
+Record GATT traffic with a desk to a trace file and replay it without the desk.
+
+Traces are JSON lines. The first line is a header and each following line is an
+operation `[start, duration, op, uuid, data]` where start is seconds since the
+trace began, duration is how long the operation took (seconds) and data is hex.
+"""
+
+import asyncio
+import json
+import math
+import time
+from collections import Counter, defaultdict, deque
+from typing import Callable, Deque, Dict, List, Optional, Tuple
+from bleak import BleakClient
+from .util import logger, hex_to_bytes
+
+TRACE_VERSION = 1
+
+CONNECT = "connect"
+DISCONNECT = "disconnect"
+READ = "read"
+WRITE = "write"
+NOTIFY = "notify"
+START_NOTIFY = "start_notify"
+STOP_NOTIFY = "stop_notify"
+
+
+class ReplayMismatch(Exception):
+    pass
+
+
+def percentile(values: List[float], percent: float) -> float:
+    """Nearest rank percentile of a non-empty list"""
+    ordered = sorted(values)
+    return ordered[max(math.ceil(percent / 100 * len(ordered)) - 1, 0)]
+
+
+def format_latencies(values: List[float]) -> str:
+    return "p50 {:.1f}ms p95 {:.1f}ms max {:.1f}ms".format(
+        1000 * percentile(values, 50), 1000 * percentile(values, 95), 1000 * max(values)
+    )
+
+
+class RecordingClient:
+    """Wraps a BleakClient, recording every operation and notification"""
+
+    def __init__(self, client: BleakClient, path: str):
+        self.client = client
+        self.path = path
+        self.file = open(path, "w", buffering=1)
+        self.started = time.perf_counter()
+        self.file.write(
+            json.dumps({"version": TRACE_VERSION, "address": client.address}) + "\n"
+        )
+
+    def __getattr__(self, name):
+        return getattr(self.client, name)
+
+    def record(
+        self, start: float, op: str, uuid=None, data: Optional[bytearray] = None
+    ) -> None:
+        if self.file.closed:
+            return
+        now = time.perf_counter()
+        self.file.write(
+            json.dumps(
+                [
+                    round(start - self.started, 6),
+                    round(now - start, 6),
+                    op,
+                    str(uuid).lower() if uuid else None,
+                    bytes(data).hex() if data else None,
+                ]
+            )
+            + "\n"
+        )
+
+    async def connect(self, **kwargs) -> None:
+        if self.file.closed:
+            # Reconnecting after disconnect() continues the same trace
+            self.file = open(self.path, "a", buffering=1)
+        start = time.perf_counter()
+        await self.client.connect(**kwargs)
+        self.record(start, CONNECT)
+
+    async def disconnect(self) -> None:
+        start = time.perf_counter()
+        try:
+            await self.client.disconnect()
+        finally:
+            self.record(start, DISCONNECT)
+            self.file.close()
+
+    async def read_gatt_char(self, uuid, **kwargs) -> bytearray:
+        start = time.perf_counter()
+        data = await self.client.read_gatt_char(uuid, **kwargs)
+        self.record(start, READ, uuid, data)
+        return data
+
+    async def write_gatt_char(self, uuid, data, **kwargs) -> None:
+        start = time.perf_counter()
+        await self.client.write_gatt_char(uuid, data, **kwargs)
+        self.record(start, WRITE, uuid, data)
+
+    async def start_notify(self, uuid, callback, **kwargs) -> None:
+        def record_callback(sender, data):
+            now = time.perf_counter()
+            self.record(now, NOTIFY, uuid, data)
+            return callback(sender, data)
+
+        start = time.perf_counter()
+        await self.client.start_notify(uuid, record_callback, **kwargs)
+        self.record(start, START_NOTIFY, uuid)
+
+    async def stop_notify(self, uuid) -> None:
+        start = time.perf_counter()
+        await self.client.stop_notify(uuid)
+        self.record(start, STOP_NOTIFY, uuid)
+
+
+def load_trace(path: str) -> Tuple[dict, List[list]]:
+    with open(path, "r") as stream:
+        header = json.loads(stream.readline())
+        if header.get("version") != TRACE_VERSION:
+            raise ValueError("Unsupported trace version: {}".format(header.get("version")))
+        return header, [json.loads(line) for line in stream if line.strip()]
+
+
+class ReplayClient:
+    """
+    Stands in for a BleakClient, answering operations from a trace. Operations are
+    matched to the next recorded operation of the same kind on the same
+    characteristic, so unrelated characteristics may be used in a different order.
+    Notifications are delivered at their recorded times after the operation
+    preceding them. Timings are divided by speed, and a speed of 0 replays without
+    any delays.
+
+    Operations that were not recorded, recorded operations that were never made and
+    writes of different data are counted and reported on disconnect, or raise
+    ReplayMismatch straight away when strict. The latency of each kind of operation
+    is reported next to the recorded latency of the operations it was matched to.
+    """
+
+    def __init__(self, path: str, speed: float = 1.0, strict: bool = False):
+        header, self.events = load_trace(path)
+        self.address = header.get("address")
+        self.speed = speed
+        self.strict = strict
+        self.pending: Dict[Tuple[str, Optional[str]], Deque[int]] = {}
+        for index, (_, _, op, uuid, _) in enumerate(self.events):
+            if op != NOTIFY:
+                self.pending.setdefault((op, uuid), deque()).append(index)
+        self.replayed = set()
+        self.position = 0  # events before this have been replayed or delivered
+        self.callbacks: Dict[str, Callable] = {}
+        self.reads: Dict[str, bytearray] = {}
+        self.counts: Counter = Counter()
+        self.extra: Counter = Counter()
+        self.mismatched: Counter = Counter()
+        self.latencies: Dict[str, List[float]] = defaultdict(list)
+        self.recorded_latencies: Dict[str, List[float]] = defaultdict(list)
+        self.is_connected = True
+        self.started = time.perf_counter()
+
+    def mismatch(self, counter: Counter, op: str, uuid, message: str) -> None:
+        counter["{} {}".format(op, uuid) if uuid else op] += 1
+        if self.strict:
+            raise ReplayMismatch(message)
+
+    async def replay(self, op: str, uuid=None, data: Optional[bytearray] = None):
+        uuid = str(uuid).lower() if uuid else None
+        queue = self.pending.get((op, uuid))
+        if not queue:
+            self.mismatch(
+                self.extra, op, uuid, "{} {} was not recorded".format(op, uuid)
+            )
+            return self.reads.get(uuid, bytearray())
+        index = queue.popleft()
+        start, duration, _, _, recorded_data = self.events[index]
+        if op == WRITE and bytes(data).hex() != recorded_data:
+            self.mismatch(
+                self.mismatched,
+                op,
+                uuid,
+                "Expected write of {} but got {} at operation {}".format(
+                    recorded_data, bytes(data).hex(), index
+                ),
+            )
+        self.replayed.add(index)
+        self.counts[op] += 1
+        self.deliver_notifications(index)
+        called = time.perf_counter()
+        if self.speed:
+            await asyncio.sleep(duration / self.speed)
+        self.latencies[op].append(time.perf_counter() - called)
+        self.recorded_latencies[op].append(duration)
+        self.deliver_notifications(index + 1, start + duration)
+        result = hex_to_bytes(recorded_data) if recorded_data else bytearray()
+        if op == READ:
+            self.reads[uuid] = result
+        return result
+
+    def deliver_notifications(self, until: int, since: Optional[float] = None) -> None:
+        """
+        Deliver the notifications recorded before event until, then schedule those
+        straight after it relative to since
+        """
+        loop = asyncio.get_running_loop()
+        while self.position < len(self.events) and (
+            self.position < until or self.events[self.position][2] == NOTIFY
+        ):
+            start, _, op, uuid, data = self.events[self.position]
+            self.position += 1
+            if op != NOTIFY:
+                continue
+            self.counts[NOTIFY] += 1
+            callback = self.callbacks.get(uuid)
+            if not callback:
+                continue
+            delay = 0
+            if self.speed and since is not None and self.position > until:
+                delay = max(0, start - since) / self.speed
+            loop.call_later(delay, callback, uuid, hex_to_bytes(data))
+
+    async def connect(self, **kwargs) -> None:
+        await self.replay(CONNECT)
+        self.is_connected = True
+
+    async def disconnect(self) -> None:
+        if self.pending.get((DISCONNECT, None)):
+            await self.replay(DISCONNECT)
+        self.is_connected = False
+        missing: Counter = Counter()
+        for (op, uuid), queue in self.pending.items():
+            if queue:
+                missing["{} {}".format(op, uuid) if uuid else op] += len(queue)
+        recorded = max(
+            (self.events[index][0] for index in self.replayed), default=0
+        )
+        logger.log(
+            "Replayed {} of {} operations in {:.2f}s (recorded {:.2f}s): {}".format(
+                len(self.replayed),
+                sum(1 for event in self.events if event[2] != NOTIFY),
+                time.perf_counter() - self.started,
+                recorded,
+                dict(self.counts),
+            )
+        )
+        for op, latencies in self.latencies.items():
+            logger.log(
+                "  {}: {} (recorded {})".format(
+                    op,
+                    format_latencies(latencies),
+                    format_latencies(self.recorded_latencies[op]),
+                )
+            )
+        for name, counter in [
+            ("Extra", self.extra),
+            ("Missing", missing),
+            ("Mismatched", self.mismatched),
+        ]:
+            if counter:
+                logger.log("{} operations: {}".format(name, dict(counter)))
+
+    async def read_gatt_char(self, uuid, **kwargs) -> bytearray:
+        return await self.replay(READ, uuid)
+
+    async def write_gatt_char(self, uuid, data, **kwargs) -> None:
+        await self.replay(WRITE, uuid, data)
+
+    async def start_notify(self, uuid, callback, **kwargs) -> None:
+        self.callbacks[str(uuid).lower()] = callback
+        await self.replay(START_NOTIFY, uuid)
+
+    async def stop_notify(self, uuid) -> None:
+        await self.replay(STOP_NOTIFY, uuid)
+        self.callbacks.pop(str(uuid).lower(), None)